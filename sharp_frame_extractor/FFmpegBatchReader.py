@@ -0,0 +1,88 @@
+import queue
+import subprocess
+import threading
+from typing import Iterator, Tuple
+
+import numpy as np
+
+
+class FFmpegBatchReader:
+    def __init__(self, video_file: str, width: int, height: int, ffmpeg_path: str = "ffmpeg",
+                 prefetch_frames: int = 4, threads: int = 0, stride: int = 1):
+        self.video_file = video_file
+        self.width = width
+        self.height = height
+        self.ffmpeg_path = ffmpeg_path
+        self.prefetch_frames = prefetch_frames
+        self.threads = threads
+        self.stride = max(1, stride)
+
+    def read(self) -> Iterator[Tuple[int, np.ndarray]]:
+        # decode the whole video in one sequential pass and stream raw BGR frames over stdout
+        # (the yielded frames are reused buffers which are only valid until the next frame is requested)
+        # (decoder threads are an input option, 0 lets ffmpeg decide)
+        command = [self.ffmpeg_path, "-v", "error", "-nostdin",
+                   "-threads", str(self.threads), "-i", self.video_file]
+
+        # only every n-th frame is converted and piped, the others are dropped inside ffmpeg
+        # (passthrough timing, otherwise ffmpeg duplicates frames to keep the frame rate of the raw output)
+        # (-vsync instead of -fps_mode, which only exists since ffmpeg 5.1, newer versions still accept it)
+        if self.stride > 1:
+            command += ["-vf", "select='not(mod(n\\,%d))'" % self.stride, "-vsync", "passthrough"]
+
+        command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+
+        frame_size = self.width * self.height * 3
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=frame_size)
+
+        # the pipe is drained by a reader thread, so ffmpeg keeps decoding while the frames are analyzed
+        # (the bounded queue stalls the decoder if the analysis falls behind)
+        frames = queue.Queue(maxsize=self.prefetch_frames)
+        stopped = threading.Event()
+
+        # the pipe is read directly into a ring of frame buffers instead of allocating every frame
+        # (besides the queued frames, one is held by the consumer and one is being filled)
+        buffers = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(self.prefetch_frames + 2)]
+
+        def read_frames():
+            try:
+                frame_index = 0
+                while not stopped.is_set():
+                    buffer = buffers[frame_index % len(buffers)]
+                    if process.stdout.readinto(memoryview(buffer).cast("B")) < frame_size:
+                        break
+
+                    frames.put((frame_index * self.stride, buffer))
+                    frame_index += 1
+            finally:
+                frames.put(None)
+
+        reader = threading.Thread(target=read_frames, daemon=True)
+        reader.start()
+
+        finished = False
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    finished = True
+                    break
+
+                yield frame
+        finally:
+            # stop decoding the rest of the video if the consumer stopped early
+            # (the reader thread then runs into the end of the pipe)
+            stopped.set()
+            if not finished:
+                process.kill()
+
+            while not finished:
+                finished = frames.get() is None
+
+            reader.join()
+            process.stdout.close()
+            return_code = process.wait()
+
+        # a failing ffmpeg (e.g. unsupported input) also just closes the pipe, so the stream would look complete
+        if return_code != 0:
+            raise RuntimeError("ffmpeg exited with code %d while decoding '%s'" % (return_code, self.video_file))
@@ -1,23 +1,94 @@
+import math
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
+import numpy as np
+
+from sharp_frame_extractor.estimator.BaseEstimator import to_array
+
+# windows closer than this ahead of the current position are reached by decoding forward instead of seeking
+MAX_FORWARD_DECODE_MS = 2000
+
+# frames waiting to be written are held in memory, so decoding blocks if the writer falls this far behind
+MAX_PENDING_WRITES = 4
+
+# png is written with fast compression (zlib runs single threaded and dominates the write time at higher levels)
+WRITE_PARAMS = {"png": [cv2.IMWRITE_PNG_COMPRESSION, 1]}
+
+# frame time codes are derived from the frame index (never from container timestamps, which can be rounded
+# to whole milliseconds), so the tolerance only has to absorb floating point noise against the window boundaries
+# (otherwise a frame exactly on a boundary can fall into the previous window, e.g. when extracting all frames)
+TIME_TOLERANCE_MS = 1e-3
+
+# worker state is thread-local so the same functions can run in a process pool or a thread pool
+state = threading.local()
 
-from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator
 
-vidcap: cv2.VideoCapture = None
-estimator: BaseEstimator = None
-crop_factor: float = None
-output_path: str = None
-output_format: str = None
-min_sharpness: float = None
+def open_video(video_file, decoder_threads=0):
+    # select the ffmpeg backend explicitly to skip the backend probing on open
+    # (the decoder thread count can only be set while opening, 0 lets ffmpeg decide)
+    vidcap = cv2.VideoCapture(video_file, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, decoder_threads])
+    if not vidcap.isOpened():
+        vidcap = cv2.VideoCapture(video_file)
 
+    # frames are consumed immediately, there is no need to buffer ahead
+    vidcap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return vidcap
 
-def init_worker(params):
-    global vidcap, estimator, crop_factor, output_path, output_format, min_sharpness
-    video_file, output_path, estimator, crop_factor, output_format, min_sharpness, buffer_size = params
-    vidcap = cv2.VideoCapture(video_file)
-    vidcap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+
+def init_worker(params, thread_count=0):
+    video_file = params[0]
+
+    # opencv's own parallel loops (filters, color conversion) share the cpu's with the other workers as well
+    if thread_count > 0:
+        cv2.setNumThreads(thread_count)
+
+    init_state(params)
+    state.vidcap = open_video(video_file, thread_count)
+    state.frame_duration_ms = 1000.0 / state.vidcap.get(cv2.CAP_PROP_FPS)
+
+
+def init_state(params):
+    _, output_path, estimator, crop_factor, output_format, min_sharpness, decode_stride, use_opencl, \
+        analysis_scale, max_analysis_size, min_std = params
+    state.estimator = estimator
+    state.crop_factor = crop_factor
+    state.min_sharpness = min_sharpness
+    state.decode_stride = decode_stride
+    state.analysis_scale = analysis_scale
+    state.max_analysis_size = max_analysis_size
+    state.min_std = min_std
+    state.roi = None
+    state.roi_scale = analysis_scale
+
+    # the frame paths only differ in prefix and index (a '%' in the output path has to be escaped)
+    state.frame_path_template = os.path.join(output_path.replace("%", "%%"), "%sframe%04d." + output_format)
+    state.write_params = WRITE_PARAMS.get(output_format, [])
     estimator.setup()
 
+    # run the estimation on cv2.UMat (OpenCL) if a device is available and the estimator supports it
+    state.use_opencl = use_opencl and estimator.supports_umat and cv2.ocl.haveOpenCL()
+    if state.use_opencl:
+        cv2.ocl.setUseOpenCL(True)
+
+    # frames are encoded and written in the background while the next window is decoded
+    # (the writer threads are kept for later extractions on the same thread, e.g. the ffmpeg engine)
+    # (a forked pool process inherits the thread-local state but not the threads, so it needs its own writer)
+    if getattr(state, "writer", None) is None or state.writer_pid != os.getpid():
+        state.writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sfe-writer")
+        state.writer_pid = os.getpid()
+    state.write_slots = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+    state.pending_writes = []
+
+
+def extract_chunk(windows):
+    # windows are contiguous and in time order, so the video is scanned linearly with a single seek
+    results = [extract(window) for window in windows]
+    _wait_for_writes()
+    return results
+
 
 def extract(window):
     i, window_start_ms, window_end_ms = window
@@ -26,73 +97,214 @@ def extract(window):
     # print("analyzing batch (%.2fs to %.2fs)..."
     #      % (window_start_ms / 1000, window_end_ms / 1000))
 
-    # extracting frames and getting the one with the best metric
-    frames = _analyze_frame_batch(vidcap, window_start_ms, window_size_ms)
+    # extracting frames and keeping the one with the best metric
+    index, sharpness, image = _analyze_frame_batch(state.vidcap, window_start_ms, window_size_ms)
 
-    if len(frames) == 0:
+    if image is None:
         print("ERROR: No frames extracted (maybe a video error!)")
         return None
 
-    frames = sorted(frames, key=lambda e: e[1], reverse=True)
-    index, sharpness = frames[0]
+    return _store_frame(i, image, sharpness)
+
+
+def extract_stream(frames, windows, fps):
+    # selects the sharpest frame per window from a sequentially decoded stream of (frame_index, image) tuples
+    # and yields one result per window in time order
+    # (frames skipped by the stride are already dropped by the reader, so every streamed frame is analyzed)
+    # (the images of the stream may be reused buffers, so the best one is copied into a buffer of the window)
+    frame_duration_ms = 1000.0 / fps
+    window_iter = iter(windows)
+    i, window_start_ms, window_end_ms = next(window_iter)
+    is_last_window = len(windows) == 1
+    is_single_frame = _is_single_frame_window(window_end_ms - window_start_ms, frame_duration_ms)
+    best_sharpness, best_image = -math.inf, None
+    state.window_params = None
+
+    for frame_index, image in frames:
+        time_code = frame_index * 1000.0 / fps
+
+        # flush best frame when crossing into the next window
+        while time_code + TIME_TOLERANCE_MS >= window_end_ms and not is_last_window:
+            yield _store_frame(i, best_image, best_sharpness) if best_image is not None else None
+            i, window_start_ms, window_end_ms = next(window_iter)
+            is_last_window = i == len(windows) - 1
+            is_single_frame = _is_single_frame_window(window_end_ms - window_start_ms, frame_duration_ms)
+            best_sharpness, best_image = -math.inf, None
+            state.window_params = None
+
+        if is_single_frame:
+            best_sharpness, best_image = math.nan, image.copy()
+            continue
+
+        sharpness = _estimate_sharpness(image, skip_flat=best_image is not None)
+        if sharpness > best_sharpness:
+            best_sharpness = sharpness
+            if best_image is None:
+                best_image = image.copy()
+            else:
+                np.copyto(best_image, image)
+
+    yield _store_frame(i, best_image, best_sharpness) if best_image is not None else None
+
+    # windows past the end of the stream did not receive any frame
+    for _ in window_iter:
+        yield None
+
+    _wait_for_writes()
 
+
+def _store_frame(i, image, sharpness):
     prefix = ""
-    if sharpness < min_sharpness:
+    if sharpness < state.min_sharpness:
         print("WARNING: Sharpness not high enough (%.2fs)" % sharpness)
         prefix = "WARNING_"
 
-    # extract and store best frame
-    vidcap.set(cv2.CAP_PROP_POS_FRAMES, index)
-    success, image = vidcap.read()
+    # store best frame (already decoded while analyzing, no re-seek needed)
+    frame_path = state.frame_path_template % (prefix, i)
 
-    frame_path = os.path.join(output_path, "%sframe%04d.%s" % (prefix, i, output_format))
-    cv2.imwrite(frame_path, image)
+    # the slot is released from the writer thread, where the thread-local state is not available
+    write_slots = state.write_slots
+    write_slots.acquire()
+    future = state.writer.submit(cv2.imwrite, frame_path, image, state.write_params)
+    future.add_done_callback(lambda _: write_slots.release())
+    state.pending_writes.append(future)
 
-    return frame_path, sharpness
+    return i, frame_path, sharpness
 
 
-def _analyze_frame_batch(self, start_ms, window_ms):
-    results = []
+def _wait_for_writes():
+    # re-raises errors of the background writes
+    for future in state.pending_writes:
+        future.result()
+    state.pending_writes = []
 
-    # jump to video start
-    vidcap.set(cv2.CAP_PROP_POS_MSEC, start_ms)
-    vidcap.grab()
 
-    end_ms = start_ms + window_ms
+def _is_single_frame_window(window_ms, frame_duration_ms):
+    # a window not longer than a frame holds at most one frame, so there is nothing to compare (e.g. --all)
+    # (the sharpness is still needed if frames below the minimum sharpness have to be marked)
+    return window_ms <= frame_duration_ms + TIME_TOLERANCE_MS and state.min_sharpness <= 0
 
-    frame_available = True
-    while frame_available:
+
+def _estimate_sharpness(image, skip_flat=False):
+    # the roi only depends on the frame size, so it is calculated once from the first frame
+    # (the decoded size can differ from CAP_PROP_FRAME_WIDTH/HEIGHT for rotated videos)
+    if state.roi is None:
+        state.roi = _calculate_roi(image.shape)
+        state.roi_scale = _calculate_roi_scale(state.roi)
+
+    roi = image[state.roi]
+    if state.use_opencl:
+        roi = cv2.UMat(roi)
+
+    # estimators only need luminance
+    roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+
+    # the ranking within a window is preserved on a downscaled roi, only the written frame has to be full size
+    if state.roi_scale != 1.0:
+        roi = cv2.resize(roi, None, fx=state.roi_scale, fy=state.roi_scale, interpolation=cv2.INTER_AREA)
+
+    # flat frames (e.g. fades or black frames) have the lowest score of every estimator,
+    # so a cheap contrast check is enough to skip them if there is already a candidate to beat
+    is_flat = False
+    if state.min_std > 0:
+        _, std = cv2.meanStdDev(roi)
+        is_flat = to_array(std)[0][0] < state.min_std
+        if is_flat and skip_flat:
+            return -math.inf
+
+    # parameters derived from the first estimated frame of a window are reused for the others
+    # (not from a flat frame, e.g. the black start of a fade, they are derived again from the next frame)
+    if state.window_params is None and not is_flat:
+        state.window_params = state.estimator.window_params(roi)
+
+    return state.estimator.estimate(roi, state.window_params)
+
+
+def _calculate_roi(shape):
+    height, width = shape[:2]
+    cw = round(width * state.crop_factor)
+    ch = round(height * state.crop_factor)
+
+    x = round((width * 0.5) - (cw * 0.5))
+    y = round((height * 0.5) - (ch * 0.5))
+
+    return slice(y, y + ch), slice(x, x + cw)
+
+
+def _calculate_roi_scale(roi):
+    # the analysis cost does not grow with the video resolution if the roi is limited to a maximum size
+    scale = state.analysis_scale
+    if state.max_analysis_size > 0:
+        longest_side = max(s.stop - s.start for s in roi)
+        scale = min(scale, state.max_analysis_size / float(longest_side))
+    return scale
+
+
+def _analyze_frame_batch(vidcap, start_ms, window_ms):
+    best_index = -1
+    best_sharpness = -math.inf
+    best_image = None
+    state.window_params = None
+
+    # time codes are derived from the frame index and not from CAP_PROP_POS_MSEC
+    # (container timestamps are often rounded to whole milliseconds, e.g. mkv, which moves frames on a window
+    # boundary into the wrong window, this assumes a constant frame rate like the windows themselves)
+    # CAP_PROP_POS_FRAMES is the number of grabbed frames, so the last grabbed frame is one before it
+    frame_index = vidcap.get(cv2.CAP_PROP_POS_FRAMES)
+    position_ms = (frame_index - 1) * state.frame_duration_ms
+
+    # jump to window start (seeking restarts decoding at the previous keyframe, so skip it if possible)
+    # (the previous window stops with the first frame of this one grabbed)
+    if frame_index > 0 \
+            and start_ms - MAX_FORWARD_DECODE_MS <= position_ms <= start_ms + TIME_TOLERANCE_MS:
+        while position_ms + TIME_TOLERANCE_MS < start_ms and vidcap.grab():
+            frame_index += 1
+            position_ms += state.frame_duration_ms
+    else:
+        vidcap.set(cv2.CAP_PROP_POS_MSEC, start_ms)
+        vidcap.grab()
+
+        # query the position once after seeking and track it locally (property queries are backend round-trips)
         frame_index = vidcap.get(cv2.CAP_PROP_POS_FRAMES)
-        time_code = vidcap.get(cv2.CAP_PROP_POS_MSEC)
 
-        # check if end of window
-        if time_code >= end_ms:
-            frame_available = False
-            continue
+    end_ms = start_ms + window_ms
+    grabbed_count = 0
+    is_single_frame = _is_single_frame_window(window_ms, state.frame_duration_ms)
 
-        # read next frame
-        success, image = vidcap.read()
+    # frames are decoded into two alternating buffers (current candidate and best so far)
+    buffer = None
 
-        # check end of stream
-        if not success:
-            frame_available = False
-            continue
+    # the last grabbed frame has not been retrieved yet, so it is the first candidate of the window
+    # (a frame at or after the end of the window stays grabbed and starts the next window)
+    grabbed_index = int(frame_index) - 1
+    frame_available = grabbed_index >= 0
+    while frame_available:
+        time_code = grabbed_index * state.frame_duration_ms
 
-        # crop roi if necessary
-        if crop_factor != 1.0:
-            height, width, channels = image.shape
-            cw = round(width * crop_factor)
-            ch = round(height * crop_factor)
+        # check if end of window
+        if time_code + TIME_TOLERANCE_MS >= end_ms:
+            break
 
-            x = round((width * 0.5) - (cw * 0.5))
-            y = round((height * 0.5) - (ch * 0.5))
+        # only retrieve every n-th frame (a seek can land slightly before the window start)
+        if time_code + TIME_TOLERANCE_MS >= start_ms:
+            grabbed_count += 1
 
-            image = image[y:y + ch, x:x + cw]
+        if grabbed_count > 0 and (grabbed_count - 1) % state.decode_stride == 0:
+            success, image = vidcap.retrieve(buffer)
+            if success:
+                if is_single_frame:
+                    return grabbed_index, math.nan, image
 
-        # extract metrics
-        sharpness = estimator.estimate(image)
-        results.append((frame_index, sharpness))
+                # extract metrics and keep the running best, the other buffer is reused for the next frame
+                sharpness = _estimate_sharpness(image, skip_flat=best_image is not None)
+                if sharpness > best_sharpness:
+                    buffer = best_image
+                    best_index, best_sharpness, best_image = grabbed_index, sharpness, image
+                else:
+                    buffer = image
 
-        frame_available = True
+        # advance decoder without converting the frame
+        frame_available = vidcap.grab()
+        grabbed_index += 1
 
-    return results
+    return best_index, best_sharpness, best_image
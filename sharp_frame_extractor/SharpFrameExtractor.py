@@ -1,13 +1,17 @@
 import math
 import multiprocessing
 import os
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
 import cv2
+import numpy as np
 import tqdm
 
-from sharp_frame_extractor.SFEWorker import init_worker, extract
+from sharp_frame_extractor.FFmpegBatchReader import FFmpegBatchReader
+from sharp_frame_extractor.SFEWorker import init_worker, init_state, extract_chunk, extract_stream, open_video
 from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator
 
 
@@ -16,10 +20,17 @@ class SharpFrameExtractor:
                  min_sharpness=-1,
                  crop_factor=0.25,
                  output_format="png",
-                 cpu_count=multiprocessing.cpu_count(),
+                 cpu_count=max(1, multiprocessing.cpu_count() // 4),
                  force_cpu_count=False,
                  extract_all=False,
-                 preview=False):
+                 preview=False,
+                 decode_stride=1,
+                 use_threads=False,
+                 engine="opencv",
+                 use_opencl=False,
+                 analysis_scale=1.0,
+                 max_analysis_size=0,
+                 min_std=0.0):
         self.estimator = estimator
         self.min_sharpness = min_sharpness
         self.crop_factor = crop_factor
@@ -28,29 +39,43 @@ class SharpFrameExtractor:
         self.preview = preview
         self.force_cpu_count = force_cpu_count
         self.extract_all = extract_all
+        self.decode_stride = max(1, decode_stride)
+        self.use_threads = use_threads
+        self.engine = engine
+        self.use_opencl = use_opencl
+        self.analysis_scale = analysis_scale
+        if analysis_scale <= 0:
+            raise ValueError("analysis_scale has to be greater than 0 (got %s)" % analysis_scale)
+        self.max_analysis_size = max_analysis_size
+        if max_analysis_size < 0:
+            raise ValueError("max_analysis_size has to be 0 (disabled) or greater (got %s)" % max_analysis_size)
+        self.min_std = min_std
 
     def extract(self, video_file, output_path, window_size_ms, target_frame_count: int = -1):
         start_time = time.time()
-        vidcap = cv2.VideoCapture(video_file)
 
-        success, frame = vidcap.read()
+        # read the video properties (valid right after opening, no frame has to be decoded)
+        vidcap = open_video(video_file)
+        fps = vidcap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        vidcap.release()
 
         # prepare paths
         if not os.path.exists(output_path) and not self.preview:
             os.makedirs(output_path)
 
         # prepare vars
-        fps = vidcap.get(cv2.CAP_PROP_FPS)
-        frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
         video_length_ms = frame_count / float(fps) * 1000
 
         # calculate window if frame_count is set
-        if target_frame_count > 0:
+        if 0 < target_frame_count < frame_count:
             window_size_ms = video_length_ms / target_frame_count
             print("set window size to %.2fms to create %d frames!" % (window_size_ms, target_frame_count))
 
-        # option to extract all the frames
-        if self.extract_all:
+        # option to extract all the frames (also if at least as many frames as the video has are requested)
+        if self.extract_all or target_frame_count >= frame_count:
             window_size_ms = video_length_ms / frame_count
             print("extracting all %d frames!" % frame_count)
 
@@ -63,48 +88,98 @@ class SharpFrameExtractor:
             print("Sharp Frame Extractor running in preview mode!")
             exit(0)
 
-        # create windows
-        windows = []
-        for i in range(0, step_count):
-            window_start_ms = i * window_size_ms
-            window_end_ms = window_start_ms + window_size_ms
+        # create windows (the last window is extended to the end of the video)
+        indices = np.arange(step_count)
+        starts = indices * window_size_ms
+        ends = starts + window_size_ms
+        ends[-1:] = video_length_ms
+        windows = list(zip(indices.tolist(), starts.tolist(), ends.tolist()))
+
+        worker_params = (video_file,
+                         output_path,
+                         self.estimator,
+                         self.crop_factor,
+                         self.output_format,
+                         self.min_sharpness,
+                         self.decode_stride,
+                         self.use_opencl,
+                         self.analysis_scale,
+                         self.max_analysis_size,
+                         self.min_std)
+
+        if self.engine == "ffmpeg":
+            results = self._extract_ffmpeg(video_file, windows, worker_params, fps, width, height)
+        else:
+            results = self._extract_pool(windows, worker_params, step_count)
+
+        # collect results per window (structure of arrays, filled by window index)
+        frame_paths = [None] * len(windows)
+        sharpness_scores = np.full(len(windows), np.nan, dtype=np.float32)
+        for res in tqdm.tqdm(results, total=len(windows), desc="frame extraction"):
+            if res is None:
+                continue
+            i, frame_path, sharpness = res
+            frame_paths[i] = frame_path
+            sharpness_scores[i] = sharpness
 
-            # check if it is last window
-            if i == step_count - 1:
-                window_end_ms = video_length_ms
+        end_time = time.time()
 
-            windows.append((i, window_start_ms, window_end_ms))
-        vidcap.release()
+        # frames of single frame windows are not estimated (nan)
+        frames = [frame_path for frame_path in frame_paths if frame_path is not None]
+        if not np.isnan(sharpness_scores).all():
+            print("Sharpness of extracted frames: min %.2f, mean %.2f, max %.2f"
+                  % (np.nanmin(sharpness_scores), np.nanmean(sharpness_scores), np.nanmax(sharpness_scores)))
 
-        # define buffer size
-        buffer_size = math.ceil(frame_count / len(windows) * 1.5)
+        print("Took %.4f seconds to extract %d frames!" % (end_time - start_time, len(windows)))
+        return frames
 
-        # calculate max processor count (by default take 25% of CPU's)
-        processor_count = max(1, min(round(self.cpu_count * 0.25), step_count))
+    def _extract_pool(self, windows, worker_params, step_count):
+        # calculate max processor count (no more workers than windows)
+        processor_count = max(1, min(self.cpu_count, step_count))
 
         if self.force_cpu_count:
             processor_count = self.cpu_count
 
-        # run multiprocessing
-        print("Using a pool of %d CPU's with buffer size %d..." % (processor_count, buffer_size))
-        results = []
-        with Pool(processes=processor_count, initializer=init_worker,
-                  initargs=((video_file,
-                             output_path,
-                             self.estimator,
-                             self.crop_factor,
-                             self.output_format,
-                             self.min_sharpness,
-                             buffer_size),)) as pool:
-            for res in tqdm.tqdm(pool.imap_unordered(extract, windows), total=len(windows), desc="frame extraction"):
-                if res is None:
-                    continue
-                name, sharpness = res
-                results.append(name)
-
-        end_time = time.time()
-
-        frames = [result[0] for result in results if result is not None]
-
-        print("Took %.4f seconds to extract %d frames!" % (end_time - start_time, len(windows)))
-        return frames
+        # run multiprocessing (or threads, OpenCV releases the GIL while decoding and filtering)
+        print("Using a %s of %d CPU's..." % ("thread pool" if self.use_threads else "pool", processor_count))
+
+        # split windows into contiguous chunks so every worker scans its part of the video linearly
+        # (about four chunks per worker to balance the load, while still amortizing seeks and task dispatch)
+        chunk_size = max(1, len(windows) // (processor_count * 4))
+        chunks = [windows[i:i + chunk_size] for i in range(0, len(windows), chunk_size)]
+
+        # share the cpu's between all workers instead of letting the decoder and opencv of every worker use all of them
+        thread_count = max(1, multiprocessing.cpu_count() // processor_count)
+
+        if self.use_threads:
+            pool = ThreadPoolExecutor(max_workers=processor_count, initializer=init_worker,
+                                      initargs=(worker_params, thread_count))
+            map_chunks = pool.map
+        else:
+            pool = Pool(processes=processor_count, initializer=init_worker, initargs=(worker_params, thread_count))
+            map_chunks = pool.imap_unordered
+
+        with pool:
+            for chunk_results in map_chunks(extract_chunk, chunks):
+                yield from chunk_results
+
+    def _extract_ffmpeg(self, video_file, windows, worker_params, fps, width, height):
+        ffmpeg_path = shutil.which("ffmpeg")
+        if ffmpeg_path is None:
+            print("ERROR: ffmpeg executable not found (required by the ffmpeg engine)!")
+            return
+
+        # nothing to select (video shorter than a window), so there is no need to decode at all
+        if len(windows) == 0:
+            return
+
+        # single sequential decode in one ffmpeg process, no seeking at all
+        print("Using ffmpeg to decode the video in a single pass...")
+        init_state(worker_params)
+
+        # the decoder uses all cpu's unless an exact cpu count is forced
+        decoder_threads = self.cpu_count if self.force_cpu_count else 0
+        reader = FFmpegBatchReader(video_file, width, height, ffmpeg_path,
+                                   threads=decoder_threads, stride=self.decode_stride)
+
+        yield from extract_stream(reader.read(), windows, fps)
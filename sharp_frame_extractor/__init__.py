@@ -1,7 +1,9 @@
 from sharp_frame_extractor.estimator.CannyEstimator import CannyEstimator
+from sharp_frame_extractor.estimator.LaplacianEstimator import LaplacianEstimator
 from sharp_frame_extractor.estimator.SobelEstimator import SobelEstimator
 
 DefaultEstimators = {
     "canny": CannyEstimator(),
+    "laplacian": LaplacianEstimator(),
     "sobel": SobelEstimator()
 }
@@ -22,18 +22,45 @@ def parse_arguments():
                    help="Amount of output frames. "
                         "If the value is >0 the extractor calculates the window size to match the output frames.")
     a.add_argument("--all", action='store_true', help="Extracts all the frames of the video.")
+    a.add_argument("--stride", default=1, type=int,
+                   help="Only every n-th frame is analyzed, counted from the start of every window "
+                        "(opencv engine) or of the video (ffmpeg engine) (default: 1).")
     a.add_argument("--crop", default=0.25, type=float, help="Crop to center factor for ROI  sharpness detection.")
+    a.add_argument("--scale", default=1.0, type=float,
+                   help="Scale factor applied to the ROI before the sharpness detection, "
+                        "e.g. 0.5 for four times less pixels (default: 1.0).")
+    a.add_argument("--max-size", default=0, type=int,
+                   help="Maximum size in pixels of the longer ROI side for the sharpness detection, "
+                        "larger ROIs are downscaled (default: 0, disabled).")
     a.add_argument("--min", default=0, type=float,
                    help="Minimum sharpness level which is dependent on the detection method used.")
+    a.add_argument("--min-std", default=0, type=float,
+                   help="Frames with a lower standard deviation of the ROI luminance are treated as flat "
+                        "(e.g. fades) and skipped once a window has a candidate (default: 0, disabled).")
     a.add_argument("--output", default='frames', help="Path where to store the frames.")
     a.add_argument("--format", default="png", choices=['jpg', 'png', 'bmp', 'gif', 'tif'], help="Frame output format.")
     a.add_argument("--cpu-count", default=avg_cpu_count, type=int,
                    help="How many CPU's are used for the extraction "
                         f"(default: {avg_cpu_count}).")
     a.add_argument("--force-cpu-count", action='store_true', help="Forces to use exact CPU number.")
+    a.add_argument("--engine", default="opencv", choices=["opencv", "ffmpeg"],
+                   help="Decoding engine, ffmpeg decodes the video in a single sequential pass "
+                        "(requires ffmpeg on the path, default: opencv).")
+    a.add_argument("--opencl", action='store_true',
+                   help="Runs the sharpness estimation on an OpenCL device if available (canny and laplacian).")
+    a.add_argument("--threads", action='store_true',
+                   help="Uses threads instead of processes for the extraction (faster start-up, e.g. on Windows).")
     a.add_argument("--preview", action='store_true', help="Only shows how many frames would be extracted.")
     a.add_argument("--debug", action='store_true', help="Shows debug frames and information.")
-    return a.parse_args()
+    args = a.parse_args()
+
+    if args.scale <= 0:
+        a.error("argument --scale: has to be greater than 0")
+
+    if args.max_size < 0:
+        a.error("argument --max-size: has to be 0 (disabled) or greater")
+
+    return args
 
 
 def main():
@@ -45,16 +72,27 @@ def main():
                                     cpu_count=args.cpu_count,
                                     preview=args.preview,
                                     force_cpu_count=args.force_cpu_count,
-                                    extract_all=args.all)
+                                    extract_all=args.all,
+                                    decode_stride=args.stride,
+                                    use_threads=args.threads,
+                                    engine=args.engine,
+                                    use_opencl=args.opencl,
+                                    analysis_scale=float(args.scale),
+                                    max_analysis_size=args.max_size,
+                                    min_std=float(args.min_std))
 
     # check if file exists
     if not os.path.exists(args.video):
         print("input %s does not exist!" % args.video)
         exit(1)
 
-    extractor.extract(args.video, args.output,
-                      window_size_ms=int(args.window),
-                      target_frame_count=args.frame_count)
+    try:
+        extractor.extract(args.video, args.output,
+                          window_size_ms=int(args.window),
+                          target_frame_count=args.frame_count)
+    except RuntimeError as e:
+        print("ERROR: %s" % e)
+        exit(1)
     exit(0)
 
 
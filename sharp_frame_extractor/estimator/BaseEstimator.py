@@ -1,9 +1,18 @@
 from abc import ABC, abstractmethod
 
+import cv2
 import numpy as np
 
 
+def to_array(value):
+    # results of OpenCV calls on cv2.UMat input stay on the (OpenCL) device until downloaded
+    return value.get() if isinstance(value, cv2.UMat) else value
+
+
 class BaseEstimator(ABC):
+    # estimators which only use OpenCV calls can process cv2.UMat input (transparent OpenCL)
+    supports_umat = False
+
     @abstractmethod
     def setup(self):
         pass
@@ -13,9 +22,14 @@ class BaseEstimator(ABC):
         pass
 
     @abstractmethod
-    def estimate(self, image: np.ndarray) -> float:
+    def estimate(self, image: np.ndarray, window_params=None) -> float:
         pass
 
+    def window_params(self, image: np.ndarray):
+        # parameters which can be shared by all frames of a window (adjacent frames are almost the same)
+        # the worker derives them from the first frame and passes them to estimate() for the others
+        return None
+
     def __enter__(self):
         self.setup()
         return self
@@ -1,30 +1,73 @@
+import math
+import threading
+
 import cv2
 import numpy as np
 
-from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator
+from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator, to_array
+
+# the cuda canny detector keeps its thresholds as state, so every worker thread gets its own
+_cuda = threading.local()
+
+
+def _is_cuda_available() -> bool:
+    return hasattr(cv2, "cuda") and cv2.cuda.getCudaEnabledDeviceCount() > 0
 
 
 class CannyEstimator(BaseEstimator):
+    supports_umat = True
+
     def setup(self):
-        pass
+        _cuda.detector = None
+        if _is_cuda_available():
+            _cuda.detector = cv2.cuda.createCannyEdgeDetector(0, 0)
 
     def release(self):
-        pass
+        _cuda.detector = None
 
-    def estimate(self, image: np.ndarray) -> float:
-        # extract best parameters for canny
-        v = np.median(image)
+    def window_params(self, image: np.ndarray):
+        # a median of 0 (e.g. a black frame) gives thresholds which only detect noise,
+        # so no thresholds are shared and the next frame is measured instead
+        lower, upper = self._thresholds(self._to_gray(image))
+        return (lower, upper) if upper > 0 else None
 
-        sigma = 0.33
-        lower = int(max(0, (1.0 - sigma) * v))
-        upper = int(min(255, (1.0 + sigma) * v))
+    def estimate(self, image: np.ndarray, window_params=None) -> float:
+        image = self._to_gray(image)
 
-        # detect mean and standard deviation
-        edges = cv2.Canny(image, lower, upper)
-        mean, std = cv2.meanStdDev(edges)
+        # thresholds of the window (if passed by the worker) or of this image
+        lower, upper = window_params if window_params is not None else self._thresholds(image)
 
-        # unpack values
-        mean = mean[0][0]
-        std = std[0][0]
+        # detect edges (on the gpu if possible)
+        detector = getattr(_cuda, "detector", None)
+        if detector is not None and isinstance(image, np.ndarray):
+            detector.setLowThreshold(lower)
+            detector.setHighThreshold(upper)
+
+            gpu_image = cv2.cuda_GpuMat()
+            gpu_image.upload(image)
+            edges = detector.detect(gpu_image).download()
+        else:
+            edges = cv2.Canny(image, lower, upper)
+
+        # detect mean and standard deviation
+        # edges are binary (0 or 255), so both follow from the edge ratio of a single mean pass
+        edge_ratio = min(1.0, cv2.mean(edges)[0] / 255.0)
+        mean = 255.0 * edge_ratio
+        std = 255.0 * math.sqrt(edge_ratio * (1.0 - edge_ratio))
 
         return mean * std
+
+    @staticmethod
+    def _to_gray(image):
+        if isinstance(image, np.ndarray) and image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+    @staticmethod
+    def _thresholds(image):
+        # extract best parameters for canny (median from a 256 bin histogram, single pass without sorting)
+        cdf = to_array(cv2.calcHist([image], [0], None, [256], [0, 256])).ravel().cumsum()
+        v = np.searchsorted(cdf, int(cdf[-1]) // 2 + 1)
+
+        sigma = 0.33
+        return int(max(0, (1.0 - sigma) * v)), int(min(255, (1.0 + sigma) * v))
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator, to_array
+
+
+class LaplacianEstimator(BaseEstimator):
+    supports_umat = True
+
+    def setup(self):
+        pass
+
+    def release(self):
+        pass
+
+    def estimate(self, image: np.ndarray, window_params=None) -> float:
+        if isinstance(image, np.ndarray) and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # variance of the laplacian (single convolution, no thresholds)
+        # the 3x3 response of an 8-bit image fits into int16, which halves the bytes of a float32 buffer
+        laplacian = cv2.Laplacian(image, cv2.CV_16S, ksize=3)
+        mean, std = cv2.meanStdDev(laplacian)
+
+        std = to_array(std)[0][0]
+        return std * std
@@ -1,25 +1,36 @@
+import threading
+
 import cv2
 import numpy as np
 
 from sharp_frame_extractor.estimator.BaseEstimator import BaseEstimator
 
+# gradient buffers are reused between frames of the same size, so every worker thread gets its own
+_scratch = threading.local()
+
 
 class SobelEstimator(BaseEstimator):
     def setup(self):
-        pass
+        _scratch.gx = None
+        _scratch.gy = None
 
     def release(self):
-        pass
+        _scratch.gx = None
+        _scratch.gy = None
 
-    def estimate(self, image: np.ndarray) -> float:
-        Gx = cv2.Sobel(image, cv2.CV_32F, 1, 0)
-        Gy = cv2.Sobel(image, cv2.CV_32F, 0, 1)
+    def estimate(self, image: np.ndarray, window_params=None) -> float:
+        height, width = image.shape[:2]
 
-        normGx = cv2.norm(Gx)
-        normGy = cv2.norm(Gy)
+        gx = getattr(_scratch, "gx", None)
+        if gx is None or gx.shape != (height, width):
+            _scratch.gx = np.empty((height, width), np.int16)
+            _scratch.gy = np.empty((height, width), np.int16)
 
-        height, width, channels = image.shape
+        # the 3x3 gradients of an 8-bit image are exact in int16, which halves the bytes of a float32 buffer
+        Gx = cv2.Sobel(image, cv2.CV_16S, 1, 0, dst=_scratch.gx)
+        Gy = cv2.Sobel(image, cv2.CV_16S, 0, 1, dst=_scratch.gy)
 
-        sumSq = normGx * normGx + normGy * normGy
-        sharpness = 1. / (sumSq / (height * width) + 1e-6)
-        return (1.0 - sharpness) * 100, 0, 0
+        # squared l2 norms directly (no square root which would be squared again)
+        sumSq = cv2.norm(Gx, cv2.NORM_L2SQR) + cv2.norm(Gy, cv2.NORM_L2SQR)
+        sharpness = 1. / (sumSq / Gx.size + 1e-6)
+        return (1.0 - sharpness) * 100
@@ -1,11 +1,14 @@
 class ExponentialMovingAverage(object):
+    __slots__ = ("alpha", "value")
+
     def __init__(self, alpha=0.1):
         self.alpha = alpha
         self.value = None
 
     def add(self, value):
-        if self.value is None:
+        current = self.value
+        if current is None:
             self.value = value
             return
 
-        self.value = self.value + self.alpha * (value - self.value)
+        self.value = current + self.alpha * (value - current)